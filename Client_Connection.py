@@ -1,16 +1,26 @@
 from __future__ import print_function
 import socket, errno
+import codecs
+try:
+    import Queue
+except ImportError: #python 3
+    import queue as Queue
+import select
 import sys
-from threading import Thread
+from threading import Thread, Lock, Event
 import time
 import traceback
 import struct
 import numpy as np
 import math
+import random
+import hashlib
+import uuid
+import compression
 
 class Client_Connection():
 
-    def __init__(self, message_queue, debug=False, autoreconnect = True, MAX_name=None):
+    def __init__(self, message_queue, debug=False, autoreconnect = True, MAX_name=None, allow_compression=True):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.message_queue = message_queue
         self.debug = debug
@@ -18,9 +28,37 @@ class Client_Connection():
         self.connected = False
         self.autoreconnect = autoreconnect
         self.MAX_name = MAX_name
+        #prepare everything the read thread needs for the handshake now. On python 2 the first use of a codec imports it,
+        #which would wait for the import lock held by the driver import running in parallel (see NI_Connect.start)
+        codecs.lookup('utf-8')
+        name = (MAX_name or '').encode('utf-8')
+        self.MAX_name_packet = struct.pack('>i', len(name)) + name #reply to packet 7
         self.read_Thread = Thread(target=self.read_fun, args=(message_queue,))
+        self.read_Thread.daemon = True #may block in recv() or message_queue.join(). Don't keep the process alive because of it
         self.len_packer = struct.Struct('>i') #int 4bytes
         self.type_packer = struct.Struct('>h') #short 2bytes
+        self.ai_header_packer = struct.Struct('>iiii') #shot, first sample, samples, channels
+        self.send_lock = Lock() #the read thread and the AI acquisition thread share the socket
+        self.ai_send_timeout = 0.5 #an AI data packet is dropped if the socket cannot take it within this time (in s)
+        self.generation = 0 #counts the successful connects
+        self.ai_ready_generation = None #the connection on which AI data may be sent (set after the session request, packet 11)
+        self.ai_shot = None #the AI shot of the last chunk and the connection it started on
+        self.ai_shot_generation = None
+        self.connect_time = None #time of the last successful connect, to log the MAX name handshake
+        self.allow_compression = allow_compression
+        self.compression = None #the codec negotiated for this connection (packet 10), None for uncompressed data
+
+        #reconnect with exponential backoff: wait between min_ and max_reconnect_delay (in s), plus random jitter
+        self.min_reconnect_delay = 0.5
+        self.max_reconnect_delay = 30.0
+        self.reconnect_delay = self.min_reconnect_delay
+        self.stop_event = Event() #set by close() to interrupt waiting for the next reconnect attempt
+
+        #session identity: BLACS can resume a session with a rerun if the device is still armed with the same shot
+        self.session_token = uuid.uuid4().hex #new for every process, since the hardware tasks do not survive a restart
+        self.last_shot_hash = None #hash of the last programmed buffered shot
+        self.shot_rerunnable = False #True if the device can rerun the last programmed shot
+        self.result_queue = Queue.Queue() #the device reports here whether a transition to buffered succeeded
 
     def connect(self, server_address, reconnect = False):
         """
@@ -40,11 +78,14 @@ class Client_Connection():
             self.socket.connect(server_address)
 #            self.socket.settimeout(0) #make blocking again
             if self.debug: print('connected successfully')
+            self.compression = None #a new connection starts uncompressed until BLACS negotiates a codec
+            self.connect_time = time.time()
+            self.generation += 1
             self.connected = True
-            if not reconnect: #if it's a reconnect, the thread is already running
-                self.read_Thread.start()
         except Exception as ex:
             print('Error. cannot connect to server: '+str(ex), sys.stderr) 
+        if not reconnect and (self.connected or self.autoreconnect): #if it's a reconnect, the thread is already running
+            self.read_Thread.start()
 
     def close(self):
         """
@@ -52,8 +93,134 @@ class Client_Connection():
         """
         print("closing network connection")
         self.running = False
+        self.stop_event.set()
         self.socket.close()
 
+    def wait_before_reconnect(self):
+        """
+        Wait before the next reconnect attempt. The delay doubles with every failed attempt (up to max_reconnect_delay)
+        and is randomised, so that several clients do not reconnect to BLACS at the same moment
+
+        Returns
+        -------
+        bool
+            False if the connection was closed while waiting
+        """
+        delay = self.reconnect_delay * random.uniform(0.5, 1.0)
+        self.reconnect_delay = min(2 * self.reconnect_delay, self.max_reconnect_delay)
+        print("not connected. Trying to reconnect in %.1f s..."%delay)
+        return not self.stop_event.wait(delay)
+
+    def hash_shot(self, msg, data):
+        """
+        Return the hash of a buffered shot
+
+        The hash is the sha1 of the utf-8 packet string (transition to buffered) followed by the
+        array data as sent by BLACS (big-endian float32 or int8, C order)
+        """
+        shot_hash = hashlib.sha1(msg.encode('utf-8'))
+        shot_hash.update(np.ascontiguousarray(data))
+        return shot_hash.hexdigest()
+
+    def device_succeeded(self):
+        """
+        Return the result the device reported for the last transition to buffered (False if there is none)
+        """
+        success = False
+        while True:
+            try:
+                success = self.result_queue.get_nowait()
+            except Queue.Empty:
+                return success
+
+    def send(self, *buffers):
+        """
+        Send the given buffers to BLACS without being interleaved by other threads
+
+        Parameters
+        ----------
+        buffers : str / buffer objects
+            The buffers to send, in order. They are sent without copying them into one message
+        """
+        with self.send_lock:
+            for buf in buffers:
+                self.socket.sendall(buf)
+
+    def send_before(self, deadline, *buffers):
+        """
+        Send the given buffers to BLACS if the socket becomes writable before the deadline. The caller must hold the send_lock
+
+        The deadline only applies to starting the packet. Once the first byte is sent, the packet is always completed,
+        since dropping the rest would break the packet stream to BLACS.
+
+        Returns
+        -------
+        bool
+            False if nothing is sent since the deadline was reached
+        """
+        _, writable, _ = select.select([], [self.socket], [], max(deadline - time.time(), 0))
+        if not writable:
+            return False
+        for buf in buffers:
+            self.socket.sendall(buf)
+        return True
+
+    def recv_exact(self, n):
+        """
+        Receive exactly n bytes from BLACS
+
+        Raises socket.error if the connection is closed before all bytes are received
+        """
+        buf = bytearray(n)
+        view = memoryview(buf)
+        received = 0
+        while received < n:
+            amount = self.socket.recv_into(view[received:], n - received)
+            if not amount:
+                raise socket.error(errno.ECONNRESET, "connection closed while receiving data")
+            received += amount
+        return bytes(buf)
+
+    def send_ai_data(self, shot, first_sample, ai_data):
+        """
+        Stream a chunk of acquired analog input samples to BLACS
+
+        AI data is only sent once BLACS has requested the session (packet 11) on the current connection, so it is
+        never mixed into the replies of the handshake. Chunks of a shot that started on an earlier connection are dropped.
+
+        A AI data packet consists of:
+            2 bytes          packet type (9)
+            4 bytes          data length in bytes
+            4 bytes          shot number
+            4 bytes          index of the first sample in this chunk
+            4 bytes          number of samples
+            4 bytes          number of channels
+            arbitrary bytes  the samples as little-endian float64 (samples x channels)
+
+        Parameters
+        ----------
+        shot : int
+            A counter identifying the shot the samples belong to
+        first_sample : int
+            The index of the first sample of this chunk within the shot
+        ai_data : 2d-numpy array, float64
+            A C-contiguous array (samples x channels). It is sent without copying
+
+        Returns
+        -------
+        bool
+            False if the chunk was dropped since the session is not established or BLACS did not accept it within ai_send_timeout
+        """
+        if shot != self.ai_shot: #first chunk of a new shot
+            self.ai_shot = shot
+            self.ai_shot_generation = self.generation
+        ai_data = ai_data.astype('<f8', copy=False)
+        header = self.type_packer.pack(9) + self.len_packer.pack(ai_data.nbytes) + self.ai_header_packer.pack(shot, first_sample, ai_data.shape[0], ai_data.shape[1])
+        with self.send_lock:
+            if not self.connected or self.ai_ready_generation != self.generation or self.ai_shot_generation != self.generation:
+                return False
+            return self.send_before(time.time() + self.ai_send_timeout, header, ai_data.reshape(-1).view(np.uint8))
+
     def read_fun(self, message_queue):
         """
         The method where all TCP messages / packed are received, decoded and delegated
@@ -67,8 +234,9 @@ class Client_Connection():
 
         while self.running:
             if not self.connected:
-                print("not connected. Trying to reconnect...")
                 self.socket.close() #make sure that the socket is closed
+                if not self.wait_before_reconnect():
+                    break
                 self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.connect(self.last_server_address, reconnect=True)
             else:  
@@ -101,6 +269,9 @@ class Client_Connection():
                         msg = self.socket.recv(packet_length)
                         msg = msg.decode('utf-8')
                         msg = eval(msg) #str to dict
+                        #the device leaves the rerun mode and deletes the buffered tasks
+                        self.last_shot_hash = None
+                        self.shot_rerunnable = False
                         message_queue.put(('manual', msg))
                     elif packet_type == 3:
                         # Packet:
@@ -110,9 +281,12 @@ class Client_Connection():
                         data = eval(msg) #receive clock_terminal & used channels
                         #print("Program Fresh: "+str(data['fresh']))
                         if not data['fresh']:
+                            self.shot_rerunnable = False #the device runs the last shot again
                             message_queue.put(('trans to buff', data))
                             message_queue.join() #wait for all the tasks to be finished
-                            self.socket.send(self.type_packer.pack(5)) #send 'task done'-message to BLACS
+                            if not self.device_succeeded():
+                                self.last_shot_hash = None
+                            self.send(self.type_packer.pack(5)) #send 'task done'-message to BLACS
                             continue
 
                         shape0 = self.socket.recv(4)
@@ -120,23 +294,32 @@ class Client_Connection():
                         shape1 = self.socket.recv(4)
                         shape1, = self.len_packer.unpack(shape1)
 
-                        ao_data = np.empty(int(math.ceil(1+shape0*shape1/1024.0)*1024.0), dtype=np.dtype('>f')) #4bytes per number
-                        to_receive = 4 * shape0 * shape1 #bytes to receive
-                        received_amount = 0
-                        while received_amount < to_receive:
-                            remaining = to_receive - received_amount
-                            if remaining >= 4*1024:
-                                amount = self.socket.recv_into(ao_data[received_amount/4:received_amount/4+1024],4*1024)
-                            else:
-                                amount = self.socket.recv_into(ao_data[received_amount/4:(received_amount+remaining)/4], remaining)    
-                            received_amount += amount
-
-                        ao_data = np.resize(ao_data, (shape0, shape1))
+                        if self.compression == compression.CODEC:
+                            ao_data = np.empty((shape0, shape1), dtype=np.dtype('>f'))
+                            compression.decompress_frames_into(self.recv_exact, ao_data)
+                        else:
+                            ao_data = np.empty(int(math.ceil(1+shape0*shape1/1024.0)*1024.0), dtype=np.dtype('>f')) #4bytes per number
+                            to_receive = 4 * shape0 * shape1 #bytes to receive
+                            received_amount = 0
+                            while received_amount < to_receive:
+                                remaining = to_receive - received_amount
+                                if remaining >= 4*1024:
+                                    amount = self.socket.recv_into(ao_data[received_amount/4:received_amount/4+1024],4*1024)
+                                else:
+                                    amount = self.socket.recv_into(ao_data[received_amount/4:(received_amount+remaining)/4], remaining)    
+                                received_amount += amount
+
+                            ao_data = np.resize(ao_data, (shape0, shape1))
+                        shot_hash = self.hash_shot(msg, ao_data)
                         ao_data = ao_data.astype(np.float64)
                         data['ao_data'] = ao_data
+                        self.last_shot_hash = None
+                        self.shot_rerunnable = False
                         message_queue.put(('trans to buff',data))
                         message_queue.join() #wait for all the tasks to be finished
-                        self.socket.send(self.type_packer.pack(5)) # send 'task done'-message to BLACS
+                        if self.device_succeeded(): #only remember shots the device is actually programmed with
+                            self.last_shot_hash = shot_hash
+                        self.send(self.type_packer.pack(5)) # send 'task done'-message to BLACS
 
                     elif packet_type == 4:
                         # Packet:
@@ -146,7 +329,10 @@ class Client_Connection():
                         msg = eval(msg) #str to dict
                         message_queue.put(('trans to man', msg))
                         message_queue.join()
-                        self.socket.send(self.type_packer.pack(5)) #send 'task done'-message to BLACS
+                        if msg['abort']:
+                            self.last_shot_hash = None #the device cleared the buffered task
+                        self.shot_rerunnable = self.last_shot_hash is not None and not msg['abort']
+                        self.send(self.type_packer.pack(5)) #send 'task done'-message to BLACS
                     elif packet_type == 6:
                         # Packet:
                         #    transition to buffered using uint8 (for digital output devices)
@@ -155,9 +341,12 @@ class Client_Connection():
                         data = eval(msg) #receive clock_terminal & used channels
                         #print("Program Fresh: "+str(data['fresh']))
                         if not data['fresh']:
+                            self.shot_rerunnable = False #the device runs the last shot again
                             message_queue.put(('trans to buff', data))
                             message_queue.join() #wait for all the tasks to be finished
-                            self.socket.send(self.type_packer.pack(5)) #send 'task done'-message to BLACS
+                            if not self.device_succeeded():
+                                self.last_shot_hash = None
+                            self.send(self.type_packer.pack(5)) #send 'task done'-message to BLACS
                             continue
 
                         shape0 = self.socket.recv(4)
@@ -165,32 +354,60 @@ class Client_Connection():
                         shape1 = self.socket.recv(4)
                         shape1, = self.len_packer.unpack(shape1)
 
-                        do_data = np.empty(int(math.ceil(1+shape0*shape1/1024.0)*1024.0), dtype=np.dtype('b')) #1bytes per number
-                        to_receive = 1 * shape0 * shape1 #bytes to receive
-                        received_amount = 0
-                        while received_amount < to_receive:
-                            remaining = to_receive - received_amount
-                            if remaining >= 1*1024:
-                                amount = self.socket.recv_into(do_data[received_amount/1:received_amount/1+1024],1*1024)
-                            else:
-                                amount = self.socket.recv_into(do_data[received_amount/1:(received_amount+remaining)/1], remaining)    
-                            received_amount += amount
-
-                        do_data = np.resize(do_data, (shape0, shape1))
+                        if self.compression == compression.CODEC:
+                            do_data = np.empty((shape0, shape1), dtype=np.dtype('b'))
+                            compression.decompress_frames_into(self.recv_exact, do_data)
+                        else:
+                            do_data = np.empty(int(math.ceil(1+shape0*shape1/1024.0)*1024.0), dtype=np.dtype('b')) #1bytes per number
+                            to_receive = 1 * shape0 * shape1 #bytes to receive
+                            received_amount = 0
+                            while received_amount < to_receive:
+                                remaining = to_receive - received_amount
+                                if remaining >= 1*1024:
+                                    amount = self.socket.recv_into(do_data[received_amount/1:received_amount/1+1024],1*1024)
+                                else:
+                                    amount = self.socket.recv_into(do_data[received_amount/1:(received_amount+remaining)/1], remaining)    
+                                received_amount += amount
+
+                            do_data = np.resize(do_data, (shape0, shape1))
+                        shot_hash = self.hash_shot(msg, do_data)
                         do_data = do_data.astype(np.uint8)
                         data['do_data'] = do_data
+                        self.last_shot_hash = None
+                        self.shot_rerunnable = False
                         message_queue.put(('trans to buff',data))
                         message_queue.join() #wait for all the tasks to be finished
-                        self.socket.send(self.type_packer.pack(5)) #send 'task done'-message to BLACS
+                        if self.device_succeeded(): #only remember shots the device is actually programmed with
+                            self.last_shot_hash = shot_hash
+                        self.send(self.type_packer.pack(5)) #send 'task done'-message to BLACS
                     elif packet_type == 7:
                         # Packet:
                         #    the server requests the MAX_name
-                        msg = self.len_packer.pack(len(self.MAX_name)) + self.MAX_name.encode('utf-8')
-                        self.socket.send(msg)
+                        self.send(self.MAX_name_packet)
+                        if self.debug: print('MAX name handshake %.3f s after connect'%(time.time() - self.connect_time))
+                        self.reconnect_delay = self.min_reconnect_delay #the session is established, reset the backoff
                     elif packet_type == 8:
                         # Packet:
                         #    the server requests a connection close due to wrong MAX_name
                         self.autoreconnect = False
+                    elif packet_type == 10:
+                        # Packet:
+                        #    the server offers compressed buffered data. Answer with the codec to use (empty: uncompressed)
+                        msg = self.recv_exact(packet_length)
+                        offered = msg.decode('utf-8').split(',')
+                        codec = compression.CODEC if self.allow_compression and compression.CODEC in offered else ''
+                        self.compression = codec or None
+                        if self.debug: print('use compression: '+str(self.compression))
+                        self.send(self.len_packer.pack(len(codec)) + codec.encode('utf-8'))
+                    elif packet_type == 11:
+                        # Packet:
+                        #    the server requests the session. Answer with the session token and the hash of the shot
+                        #    the device can rerun (empty if a full upload is needed), so BLACS can resume with a rerun
+                        shot_hash = self.last_shot_hash if self.shot_rerunnable else ''
+                        msg = self.len_packer.pack(len(self.session_token)) + self.session_token.encode('utf-8')
+                        msg += self.len_packer.pack(len(shot_hash)) + shot_hash.encode('utf-8')
+                        self.send(msg)
+                        self.ai_ready_generation = self.generation #the handshake is complete, AI data may be streamed now
                     else:
                         print("Packet size: "+str(packet_length))
                         print("Packet type: "+str(packet_type))   
@@ -199,14 +416,15 @@ class Client_Connection():
                     print("read timeout")
                     continue
                 except socket.error as error:
-                    if error.errno == errno.WSAECONNRESET:    #host closed the connection
-                        self.socket.close()
-                        self.connected = False
-                        self.running = self.autoreconnect
+                    #host closed the connection or the network is down
+                    print("connection lost: "+str(error))
+                    self.socket.close()
+                    self.connected = False
+                    self.running = self.autoreconnect and not self.stop_event.is_set()
                 except Exception as ex:
                     traceback.print_exc()
                     #print("Exception in read Fun: "+str(ex))
                     self.socket.close()
                     self.connected = False
-                    self.running = self.autoreconnect
+                    self.running = self.autoreconnect and not self.stop_event.is_set()
 
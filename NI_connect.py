@@ -15,6 +15,7 @@ Options:
   -D ..., --Device=...    use specified Device (MAX name)
   -t ..., --type=...      use specified Device type (like 6713, dio, ...)
   -r, --no_reconnect      disable autoreconnect
+  -c, --no_compression    do not accept compressed buffered data from BLACS
   -h, --help              show this help
 
 Examples:
@@ -29,10 +30,13 @@ __version__ = "$Revision: 1.0 $"
 __date__ = "$Date: 2016/12/04 12:20 $"
 
 from multiprocessing import JoinableQueue
+from threading import Thread
 from Client_Connection import Client_Connection
-#from NI_device import NI_6713Device, NI_DIODevice
+from devices import DEVICE_TYPES, get_device_class
 import sys
 import getopt
+import time
+import traceback
 
 #DEFAULT_PORT = 1028
 
@@ -52,9 +56,10 @@ def main(argv):
     port = 1028 
     dev_type = "6713"
     disable_autoreconnect = False
+    disable_compression = False
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'a:p:hD:t:r',['address=','port=','help','Device=','type=',"no_reconnect"])
+        opts, args = getopt.getopt(sys.argv[1:], 'a:p:hD:t:rc',['address=','port=','help','Device=','type=',"no_reconnect","no_compression"])
     except getopt.GetoptError:
         usage()
         sys.exit(2) 
@@ -75,16 +80,18 @@ def main(argv):
             port = int(arg)
         elif opt in ('-r','--no_reconnect'):
             disable_autoreconnect = True    
+        elif opt in ('-c','--no_compression'):
+            disable_compression = True
 
     system("title NI-Connect: "+str(MAX_name)+" as "+str(dev_type)+"    BLACS: "+str(address)+":"+str(port)) #set console title
     print("Connect to BLACS "+str(address)+":"+str(port)+". Use "+str(MAX_name)+" as type "+str(dev_type)+"\n")
-    ni_connect = NI_Connect(MAX_name, address, port, dev_type, disable_autoreconnect)
+    ni_connect = NI_Connect(MAX_name, address, port, dev_type, disable_autoreconnect, disable_compression)
     ni_connect.start()        
 
 
 class NI_Connect():
 
-    def __init__(self, MAX_name, BLACS_address, BLACS_port, Device_type, disable_autoreconnect=False):
+    def __init__(self, MAX_name, BLACS_address, BLACS_port, Device_type, disable_autoreconnect=False, disable_compression=False):
         """
         Initialise the NI connect Object with the given parameters
 
@@ -100,30 +107,75 @@ class NI_Connect():
             Tell NI connect, which card type we are using (like 'dio' for NI-DIO-32HS, or '6713' for NI-PCI6713)
         disable_autoreconnect : bool
             A flag to disable the auto reconnect when the connection is lost
+        disable_compression : bool
+            A flag to refuse compressed buffered data (see compression.py)
         """
         self.msg_queue = JoinableQueue() #a quque to communicate between the network BLACS thread and the driver thread
         #initialise the network connection to BLACS
-        self.client_connection = Client_Connection(self.msg_queue, debug=True, autoreconnect=(not disable_autoreconnect), MAX_name=MAX_name)
+        self.client_connection = Client_Connection(self.msg_queue, debug=True, autoreconnect=(not disable_autoreconnect), MAX_name=MAX_name, allow_compression=(not disable_compression))
         self.BLACS_address = BLACS_address
         self.BLACS_port = BLACS_port
+        self.MAX_name = MAX_name
+        self.Device_type = Device_type
+
+        #check the device type now, but import & initialise the driver in start(), concurrently to connecting to BLACS
+        if Device_type not in DEVICE_TYPES:
+            print("unsupported device type. Supported types: "+", ".join(sorted(DEVICE_TYPES)))
+            sys.exit()
+        self.NI_device = None
+        self.init_failed = False
+        self.startup_times = [] #list of (stage, duration in s)
+
+    def init_device(self):
+        """
+        Import the driver for the selected device type, initialise the hardware and start the device driver
+
+        Runs in its own thread. An exception is printed and marks the initialisation as failed
+        """
+        try:
+            self.create_device()
+        except Exception:
+            traceback.print_exc()
+            self.init_failed = True
+
+    def create_device(self):
+        t0 = time.time()
+        device_class = get_device_class(self.Device_type)
+        t1 = time.time()
+        self.startup_times.append(('import driver', t1 - t0))
+
+        self.NI_device = device_class(self.MAX_name, self.msg_queue, ai_sink=self.client_connection.send_ai_data, result_queue=self.client_connection.result_queue)
+        t2 = time.time()
+        self.startup_times.append(('initialise hardware', t2 - t1))
 
-        #select and initialise the correct NI device driver class
-        if Device_type == '6713':
-            from devices.NI_6713_device import NI_6713Device
-            self.NI_device = NI_6713Device(MAX_name, self.msg_queue)
-        elif Device_type =='dio':
-            from devices.NI_DIO_device import NI_DIODevice
-            self.NI_device = NI_DIODevice(MAX_name, self.msg_queue)  
-        else:
-            print("unsupported device type")
-            sys.exit()    
         self.NI_device.start() #start the device driver
+        self.startup_times.append(('start driver', time.time() - t2))
 
     def start(self):
         """
         This method connects to BLACS using the parameters from  __init__() and handles keyboard inputs
+
+        The hardware initialisation runs in parallel to the connection (and MAX name handshake) with BLACS.
+        Instructions from BLACS that arrive before the hardware is ready wait in the message queue.
         """
+        t_start = time.time()
+        init_Thread = Thread(target=self.init_device)
+        init_Thread.start()
+
+        t0 = time.time()
         self.client_connection.connect((self.BLACS_address, self.BLACS_port))
+        t1 = time.time()
+        self.startup_times.append(('connect to BLACS', t1 - t0))
+
+        init_Thread.join()
+        if self.init_failed:
+            #there will never be a consumer for the message queue. The read thread is a daemon, so it cannot keep us alive
+            self.client_connection.close()
+            self.msg_queue.cancel_join_thread() #don't wait at exit for queued instructions nobody will read
+            sys.exit("cannot initialise the device")
+
+        #the MAX name handshake is logged by the read thread as soon as BLACS requests it
+        self.print_startup_times(time.time() - t_start)
         do_close = False
 
         while not do_close:
@@ -142,6 +194,15 @@ class NI_Connect():
                 self.client_connection.close()
                 self.NI_device.shutdown()       
 
+    def print_startup_times(self, total):
+        """
+        Print the duration of each startup stage. Stages of the hardware and the network run in parallel
+        """
+        print("\nstartup times:")
+        for stage, duration in self.startup_times:
+            print("  %-22s %7.3f s"%(stage, duration))
+        print("  %-22s %7.3f s"%('ready', total))
+
 if __name__ == "__main__":
     system("title NI-Connect") #set the console title
     main(sys.argv[1:])
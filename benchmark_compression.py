@@ -0,0 +1,82 @@
+from __future__ import print_function
+
+"""Compression Benchmark
+
+Compare the time to transfer typical buffered shot data raw and compressed (see compression.py)
+for different network link speeds.
+
+Usage: python benchmark_compression.py [samples]
+
+The transfer time of compressed data is: compression (BLACS) + transfer of the compressed bytes + decompression (NI connect)
+Compression only pays off if this is shorter than the transfer of the raw bytes.
+"""
+
+import sys
+import time
+import numpy as np
+import compression
+
+LINK_SPEEDS = [10e6, 100e6, 1e9] #bit/s
+
+
+def make_test_data(samples):
+    """
+    Return a dict of typical shot data: name -> array in the format that is sent over the network
+    """
+    t = np.linspace(0, 1, samples)
+    ao_ramps = np.empty((samples, 8), dtype=np.dtype('>f'))
+    for i in range(8):
+        ao_ramps[:, i] = 5*np.sin(2*np.pi*(i+1)*t) #slowly varying analog values
+    ao_steps = np.repeat(np.random.uniform(-10, 10, (samples//100+1, 8)), 100, axis=0)[:samples].astype('>f') #repeated rows
+    do_static = np.zeros((samples, 32), dtype=np.dtype('b'))
+    do_static[:, :4] = (np.arange(samples)[:, None]//1000) % 2 #few toggling lines
+    ao_noise = np.random.uniform(-10, 10, (samples, 8)).astype('>f') #worst case: incompressible
+    return {'ao ramps': ao_ramps, 'ao steps': ao_steps, 'do static': do_static, 'ao noise': ao_noise}
+
+
+def benchmark(data, repeats=3):
+    """
+    Return (raw bytes, compressed bytes, compression time, decompression time) for the given array
+    """
+    t_compress = t_decompress = float('inf')
+    for _ in range(repeats):
+        t0 = time.time()
+        frames = compression.compress_frames(data)
+        t_compress = min(t_compress, time.time() - t0)
+
+        stream = b''.join(frames)
+        position = [0]
+        def recv_exact(n):
+            chunk = stream[position[0]:position[0]+n]
+            position[0] += n
+            return chunk
+
+        dest = np.empty_like(data)
+        t0 = time.time()
+        compression.decompress_frames_into(recv_exact, dest)
+        t_decompress = min(t_decompress, time.time() - t0)
+        assert np.array_equal(dest, data)
+    return data.nbytes, len(stream), t_compress, t_decompress
+
+
+def main(argv):
+    samples = int(argv[0]) if argv else 1000000
+    print("%d samples per channel\n"%samples)
+    header = "%-10s %10s %7s %9s %9s" % ('data', 'raw MB', 'ratio', 'comp s', 'decomp s')
+    for speed in LINK_SPEEDS:
+        header += " %14s" % ('%g Mbit/s' % (speed/1e6))
+    print(header)
+
+    for name, data in sorted(make_test_data(samples).items()):
+        raw, compressed, t_compress, t_decompress = benchmark(data)
+        line = "%-10s %10.2f %7.2f %9.3f %9.3f" % (name, raw/1e6, float(raw)/compressed, t_compress, t_decompress)
+        for speed in LINK_SPEEDS:
+            t_raw = raw*8/speed
+            t_compressed = t_compress + compressed*8/speed + t_decompress
+            line += " %6.2fs/%5.2fs%s" % (t_raw, t_compressed, '*' if t_compressed < t_raw else ' ')
+        print(line)
+    print("\nraw/compressed transfer time per link speed. * compression is faster")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,127 @@
+"""Compressed framing for buffered shot data
+
+The instructions of a buffered shot (packet types 3 and 6) can be sent as a compressed frame instead of the
+raw array. The array bytes are split into chunks of whole samples. Every chunk is byte-shuffled (the first
+byte of every number, then the second byte of every number, ...) and compressed with zlib independently:
+
+    repeated for every chunk:
+        4 bytes          compressed length
+        4 bytes          raw length (a multiple of the itemsize)
+        arbitrary bytes  zlib compressed, byte-shuffled chunk
+
+The receiver decompresses chunk by chunk directly into the destination array, so only one chunk has to be
+held in memory in addition to the destination array.
+
+The compression is negotiated per connection: BLACS sends packet type 10 containing the codecs it can send,
+and the client answers with the codec it wants to use (or an empty string for uncompressed data).
+"""
+
+import struct
+import zlib
+import numpy as np
+
+CODEC = 'shuffle-zlib'
+DEFAULT_CHUNK_SIZE = 256*1024 #raw bytes per chunk
+
+chunk_header_packer = struct.Struct('>ii') #compressed length, raw length
+
+
+def compress_bound(raw_length):
+    """
+    Return the maximum size of raw_length bytes compressed with zlib (same as compressBound() of zlib)
+    """
+    return raw_length + (raw_length >> 12) + (raw_length >> 14) + (raw_length >> 25) + 13
+
+
+def shuffle(data, itemsize):
+    """
+    Byte-shuffle a contiguous array: return all first bytes of the numbers, then all second bytes, ...
+
+    Parameters
+    ----------
+    data : numpy array
+        A C-contiguous array
+    itemsize : int
+        The number of bytes per number
+    """
+    raw = np.frombuffer(data, dtype=np.uint8)
+    if itemsize == 1:
+        return raw.tobytes()
+    return raw.reshape(-1, itemsize).T.tobytes()
+
+
+def unshuffle_into(dest, shuffled, itemsize):
+    """
+    Revert shuffle() and write the result into the given destination bytes
+
+    Parameters
+    ----------
+    dest : 1d-numpy array, uint8
+        The destination bytes (a view into the destination array)
+    shuffled : bytes
+        The byte-shuffled data, same length as dest
+    itemsize : int
+        The number of bytes per number
+    """
+    src = np.frombuffer(shuffled, dtype=np.uint8)
+    if itemsize == 1:
+        dest[:] = src
+    else:
+        dest.reshape(-1, itemsize)[:] = src.reshape(itemsize, -1).T
+
+
+def compress_frames(data, chunk_size=DEFAULT_CHUNK_SIZE, level=1):
+    """
+    Compress an array into the compressed frame format (this is what the server sends)
+
+    Parameters
+    ----------
+    data : numpy array
+        The array to compress. Its bytes are sent in C order
+    chunk_size : int
+        The maximum number of raw bytes per chunk
+    level : int
+        The zlib compression level
+
+    Returns
+    -------
+    list of bytes
+        One entry (header + compressed data) per chunk
+    """
+    data = np.ascontiguousarray(data)
+    itemsize = data.dtype.itemsize
+    raw = data.reshape(-1).view(np.uint8)
+    chunk_size = max(chunk_size - chunk_size % itemsize, itemsize) #whole numbers, at least one per chunk
+    frames = []
+    for start in range(0, raw.size, chunk_size):
+        chunk = raw[start:start+chunk_size]
+        compressed = zlib.compress(shuffle(chunk, itemsize), level)
+        frames.append(chunk_header_packer.pack(len(compressed), chunk.size) + compressed)
+    return frames
+
+
+def decompress_frames_into(recv_exact, dest):
+    """
+    Receive compressed frames and decompress them chunk by chunk into the destination array
+
+    Parameters
+    ----------
+    recv_exact : callable (n) -> bytes
+        A function returning exactly n bytes from the connection
+    dest : numpy array
+        The C-contiguous destination array. It is filled completely
+    """
+    itemsize = dest.dtype.itemsize
+    dest_bytes = dest.reshape(-1).view(np.uint8)
+    received = 0
+    while received < dest_bytes.size:
+        compressed_length, raw_length = chunk_header_packer.unpack(recv_exact(chunk_header_packer.size))
+        if raw_length <= 0 or received + raw_length > dest_bytes.size or raw_length % itemsize:
+            raise Exception("Invalid compressed chunk (raw length %d)"%raw_length)
+        if compressed_length <= 0 or compressed_length > compress_bound(raw_length):
+            raise Exception("Invalid compressed chunk (compressed length %d)"%compressed_length)
+        shuffled = zlib.decompress(recv_exact(compressed_length))
+        if len(shuffled) != raw_length:
+            raise Exception("Invalid compressed chunk (%d bytes instead of %d)"%(len(shuffled), raw_length))
+        unshuffle_into(dest_bytes[received:received+raw_length], shuffled, itemsize)
+        received += raw_length
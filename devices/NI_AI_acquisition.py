@@ -0,0 +1,279 @@
+import Queue
+import numpy as np
+from PyDAQmx import Task
+from PyDAQmx.DAQmxConstants import *
+from PyDAQmx.DAQmxTypes import *
+from PyDAQmx.DAQmxFunctions import DAQError
+from threading import Thread
+
+DAQmx_Err_Timeout = -200284 #DAQmx error code if a read did not get all requested samples in time
+
+
+class NI_AIAcquisition():
+    """
+    Hardware timed analog input acquisition sharing the shot clock of an output device
+
+    A device class creates one instance of this class and calls arm() / rearm() while transitioning
+    to buffered mode and finish() while transitioning to manual mode. Errors of the analog input
+    task are printed and disable the acquisition for the shot, but never stop the outputs.
+
+    The samples are read in chunks on a reader thread into a preallocated ring buffer and handed to
+    a sender thread, which streams them to BLACS via the given sink. If the network cannot keep up, chunks are dropped instead of blocking the
+    reader, so the acquisition never stalls the output arming.
+    """
+    def __init__(self, sink, chunk_size=1000, num_slots=16, limits=(-10.0, 10.0), max_rate=250000, stop_timeout=2.0):
+        """
+        Parameters
+        ----------
+        sink : callable (shot, first_sample, data) -> bool
+            Called from the sender thread for every chunk. data is a 2d-numpy array (samples x channels) which
+            is only valid during the call. Usually Client_Connection.send_ai_data
+        chunk_size : int
+            The number of samples per channel read from the driver at once
+        num_slots : int
+            The number of chunks the ring buffer can hold before chunks are dropped
+        limits : tuple (min, max)
+            The expected input voltage range
+        max_rate : float
+            The maximum expected shot clock rate. It must not exceed the sample rate of the input card
+        stop_timeout : float
+            The maximum time in seconds stop() waits for the sender thread to finish its current chunk.
+            If the sink is still busy after that, the sender finishes it in the background
+        """
+        self.sink = sink
+        self.chunk_size = chunk_size
+        self.num_slots = num_slots
+        self.limits = limits
+        self.max_rate = max_rate
+        self.stop_timeout = stop_timeout
+
+        self.ai_task = None
+        self.ai_read = int32()
+        self.ai_channels = None
+        self.clock_terminal = None
+        self.num_samples = 0
+        self.num_channels = 0
+        self.ring = None
+        self.scratch = None
+
+        self.shot = 0
+        self.dropped_chunks = 0
+        self.free_slots = Queue.Queue()
+        self.filled_slots = Queue.Queue()
+
+        self.running = False
+        self.reader_Thread = None
+        self.sender_Thread = None
+
+    def arm(self, clock_terminal, ai_channels, num_samples):
+        """
+        Configure and start the acquisition for a freshly programmed shot (or clear it if no ai_channels are requested)
+
+        Parameters are the same as for configure()
+        """
+        if not ai_channels:
+            self.finish(True)
+            return
+        try:
+            self.configure(clock_terminal, ai_channels, num_samples)
+            self.start()
+        except DAQError as error:
+            print("AI acquisition: cannot arm: "+str(error))
+            self.finish(True)
+
+    def rearm(self):
+        """
+        Start the acquisition again for a rerun of the last shot. Does nothing if the acquisition is not configured
+        """
+        if self.ai_task is None:
+            return
+        try:
+            self.start()
+        except DAQError as error:
+            print("AI acquisition: cannot rearm: "+str(error))
+            self.finish(True)
+
+    def finish(self, abort):
+        """
+        End the acquisition of the current shot
+
+        Parameters
+        ----------
+        abort : bool
+            If True, stop immediately and clear the task. Otherwise wait for the remaining samples of the shot
+            and keep the task for a rerun
+        """
+        try:
+            if abort:
+                self.stop()
+                self.clear()
+            else:
+                self.wait_until_done()
+        except DAQError as error:
+            print("AI acquisition: "+str(error))
+            self.ai_task = None
+
+    def configure(self, clock_terminal, ai_channels, num_samples):
+        """
+        Create the analog input task and preallocate the ring buffer
+
+        Parameters
+        ----------
+        clock_terminal : str
+            The device connection on which the shot clock signal is connected (e.g. 'PFI0')
+        ai_channels : str
+            The analog input channels to acquire (e.g. 'Dev3/ai0:3')
+        num_samples : int
+            The number of samples per channel to acquire during one shot (one per clock tick)
+        """
+        self.stop()
+        self.clear()
+
+        self.ai_task = Task()
+        self.ai_task.CreateAIVoltageChan(ai_channels, "", DAQmx_Val_Cfg_Default, self.limits[0], self.limits[1], DAQmx_Val_Volts, None)
+        self.ai_task.CfgSampClkTiming(clock_terminal, self.max_rate, DAQmx_Val_Rising, DAQmx_Val_FiniteSamps, num_samples)
+
+        num_channels = uInt32()
+        self.ai_task.GetTaskNumChans(byref(num_channels))
+
+        self.ai_channels = ai_channels
+        self.clock_terminal = clock_terminal
+        self.num_samples = num_samples
+        self.num_channels = num_channels.value
+
+        #preallocate the ring buffer, reuse it for every chunk of every shot
+        shape = (self.num_slots, self.chunk_size, self.num_channels)
+        if self.ring is None or self.ring.shape != shape:
+            self.ring = np.empty(shape, dtype=np.float64)
+            self.scratch = np.empty(shape[1:], dtype=np.float64) #chunks that have to be dropped are read into this buffer
+
+    def start(self):
+        """
+        Arm the analog input task (it waits for the shot clock) and start the reader and sender threads
+        """
+        if self.ai_task is None:
+            raise Exception("Cannot start acquisition. The acquisition is not configured.")
+        self.stop()
+
+        self.free_slots = Queue.Queue()
+        self.filled_slots = Queue.Queue()
+        for slot in range(self.num_slots):
+            self.free_slots.put(slot)
+        self.shot += 1
+        self.dropped_chunks = 0
+
+        self.ai_task.StartTask()
+        self.running = True
+        self.reader_Thread = Thread(target=self.reader_fun)
+        #the sender gets its own queues, so a sender that is still busy after stop() cannot take chunks of the next shot
+        self.sender_Thread = Thread(target=self.sender_fun, args=(self.shot, self.filled_slots, self.free_slots))
+        self.sender_Thread.daemon = True
+        self.sender_Thread.start()
+        self.reader_Thread.start()
+
+    def stop(self, drain_timeout=0.0):
+        """
+        Stop the acquisition
+
+        Parameters
+        ----------
+        drain_timeout : float
+            The time in seconds the chunks that are already read may still be sent. The remaining chunks are dropped
+        """
+        if self.reader_Thread is None:
+            return
+        self.running = False
+        self.reader_Thread.join() #returns within the read timeout
+        self.filled_slots.put(None) #tell the sender thread to finish
+        self.sender_Thread.join(drain_timeout)
+        if self.sender_Thread.is_alive():
+            self.drop_queued_chunks()
+            self.filled_slots.put(None)
+            self.sender_Thread.join(self.stop_timeout)
+            if self.sender_Thread.is_alive():
+                print("AI acquisition: sender thread did not finish in time")
+        self.reader_Thread = None
+        self.sender_Thread = None
+        self.ai_task.StopTask()
+        if self.dropped_chunks:
+            print("AI acquisition: dropped %d chunks"%self.dropped_chunks)
+
+    def wait_until_done(self, timeout=5.0):
+        """
+        Wait for the reader thread to read all samples of the shot and stop the acquisition
+
+        Parameters
+        ----------
+        timeout : float
+            The maximum time in seconds to wait for missing samples (e.g. if the clock stopped early)
+        """
+        if self.reader_Thread is not None:
+            self.reader_Thread.join(timeout)
+        self.stop(timeout)
+
+    def clear(self):
+        """
+        Clear the analog input task
+        """
+        if self.ai_task is not None:
+            self.ai_task.ClearTask()
+            self.ai_task = None
+
+    def drop_queued_chunks(self):
+        """
+        Drop all chunks that wait for the sender and release their ring buffer slots
+        """
+        while True:
+            try:
+                item = self.filled_slots.get_nowait()
+            except Queue.Empty:
+                return
+            if item is not None:
+                self.dropped_chunks += 1
+                self.free_slots.put(item[0])
+
+    def reader_fun(self):
+        """
+        Read the samples chunk by chunk into free ring buffer slots
+        """
+        received = 0
+        while self.running and received < self.num_samples:
+            try:
+                slot = self.free_slots.get_nowait()
+            except Queue.Empty:
+                slot = None #the sender is behind. read into a scratch slot and drop the chunk
+
+            buf = self.ring[slot] if slot is not None else self.scratch
+            amount = min(self.chunk_size, self.num_samples - received)
+            self.ai_read.value = 0
+            try:
+                self.ai_task.ReadAnalogF64(amount, 1.0, DAQmx_Val_GroupByScanNumber, buf, buf.size, byref(self.ai_read), None)
+            except DAQError as error:
+                if error.error != DAQmx_Err_Timeout: #the shot clock did not tick (yet). just try again
+                    print("AI acquisition: "+str(error))
+                    self.running = False
+
+            if self.ai_read.value > 0:
+                if slot is None:
+                    self.dropped_chunks += 1
+                else:
+                    self.filled_slots.put((slot, received, self.ai_read.value))
+                received += self.ai_read.value
+            elif slot is not None:
+                self.free_slots.put(slot)
+
+    def sender_fun(self, shot, filled_slots, free_slots):
+        """
+        Hand the filled ring buffer slots to the sink and release them afterwards
+        """
+        while True:
+            item = filled_slots.get()
+            if item is None:
+                break
+            slot, first_sample, amount = item
+            try:
+                if not self.sink(shot, first_sample, self.ring[slot, :amount]):
+                    self.dropped_chunks += 1
+            except Exception as ex:
+                print("AI acquisition: cannot send data: "+str(ex))
+            free_slots.put(slot)
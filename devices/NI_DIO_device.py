@@ -1,16 +1,18 @@
 import Queue
+import traceback
 import numpy as np
 from PyDAQmx import Task
 from PyDAQmx.DAQmxConstants import *
 from PyDAQmx.DAQmxTypes import *
 from threading import Thread
+from devices.NI_AI_acquisition import NI_AIAcquisition
 
 
 class NI_DIODevice():
     """
     This class is the interface to the NI driver for a NI PCI-DIO-32HS digital output card
     """    
-    def __init__(self, MAX_name, message_queue):
+    def __init__(self, MAX_name, message_queue, ai_sink=None, result_queue=None):
         """
         Initialise the driver and tasks using the given MAX name and message queue to communicate with this class
 
@@ -20,6 +22,10 @@ class NI_DIODevice():
             the National Instrument MAX name used to identify the hardware card
         message_queue : JoinableQueue
             a message queue used to send instructions to this class
+        ai_sink : callable (shot, first_sample, data)
+            if given, analog input channels can be acquired during buffered runs and their samples are passed to this callable
+        result_queue : Queue
+            if given, True or False is put into this queue for every transition to buffered, telling if the device is programmed
         """        
         print("initialize device")
         self.NUM_DO = 32
@@ -37,6 +43,11 @@ class NI_DIODevice():
 
         self.wait_for_rerun = False
 
+        #optional analog input acquisition using the same clock as the outputs
+        self.ai_acquisition = NI_AIAcquisition(ai_sink) if ai_sink is not None else None
+
+        self.result_queue = result_queue
+
         self.running = True
         self.read_Thread = Thread(target=self.read_fun, args=(message_queue,))
 
@@ -62,10 +73,18 @@ class NI_DIODevice():
                 message_queue.task_done()
             elif typ == 'trans to buff':
                 #Transition to Buffered
-                if msg['fresh']:
-                    self.transition_to_buffered(True, msg['clock_terminal'], msg['do_channels'], msg['do_data'])
-                else:
-                    self.transition_to_buffered(False, None, None, None)
+                try:
+                    if msg['fresh']:
+                        self.transition_to_buffered(True, msg['clock_terminal'], msg['do_channels'], msg['do_data'], msg.get('ai_channels'))
+                    else:
+                        self.transition_to_buffered(False, None, None, None)
+                    success = True
+                except Exception:
+                    #print the error, but keep the thread alive and acknowledge the instruction, so the client connection does not hang
+                    traceback.print_exc()
+                    success = False
+                if self.result_queue is not None:
+                    self.result_queue.put(success) #tell the client connection whether the shot is programmed
                 message_queue.task_done() #signalize that the task is done
             elif typ == 'trans to man':
                 #Transition to Manual
@@ -87,6 +106,8 @@ class NI_DIODevice():
         """
         print("shutdown device")
         self.running = False
+        if self.ai_acquisition is not None:
+            self.ai_acquisition.finish(True)
         self.do_task.StopTask()
         self.do_task.ClearTask()
 
@@ -116,7 +137,7 @@ class NI_DIODevice():
 
         self.do_task.WriteDigitalLines(1, True, 1, DAQmx_Val_GroupByChannel, self.do_data, byref(self.do_read), None)
 
-    def transition_to_buffered(self, fresh, clock_terminal, do_channels, do_data):
+    def transition_to_buffered(self, fresh, clock_terminal, do_channels, do_data, ai_channels=None):
         """
         Transition the device to buffered mode
 
@@ -133,11 +154,15 @@ class NI_DIODevice():
             A list of all analog output channels that should be used 
         ao_data : 2d-numpy array, uint8
             A 2d-array containing the instructions for each ao_channel for every clock tick
+        ai_channels : str
+            Optional analog input channels (e.g. 'Dev3/ai0:3') which are sampled on every clock tick and streamed to BLACS
         """        
         self.do_task.StopTask()
         if not fresh:
             if not self.wait_for_rerun:
                 raise Exception("Cannot rerun Task.")
+            if self.ai_acquisition is not None:
+                self.ai_acquisition.rearm() #arm the input again before the outputs, so no clock tick is missed
             self.do_task.StartTask() #just run old task again
             return
         elif not clock_terminal or not do_channels or do_data is None:
@@ -152,6 +177,9 @@ class NI_DIODevice():
 
         #print("Wrote "+str(self.do_read)+" samples to the buffer")
 
+        if self.ai_acquisition is not None:
+            self.ai_acquisition.arm(clock_terminal, ai_channels, do_data.shape[0])
+
         self.do_task.StartTask()
 
 
@@ -159,6 +187,9 @@ class NI_DIODevice():
         """
         Stop buffered mode
         """        
+        if self.ai_acquisition is not None:
+            self.ai_acquisition.finish(abort)
+
         if abort:
             self.wait_for_rerun = False
             self.do_task.ClearTask()
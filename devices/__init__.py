@@ -0,0 +1,18 @@
+import importlib
+
+# Registry of all supported device types: type name -> (module, class name). Add new drivers here
+# The modules are imported lazily, so only the driver (and PyDAQmx) that is actually used gets loaded
+DEVICE_TYPES = {
+    '6713': ('devices.NI_6713_device', 'NI_6713Device'),
+    'dio': ('devices.NI_DIO_device', 'NI_DIODevice'),
+}
+
+
+def get_device_class(dev_type):
+    """
+    Import and return the driver class for the given device type
+
+    Raises KeyError if the device type is not registered
+    """
+    module_name, class_name = DEVICE_TYPES[dev_type]
+    return getattr(importlib.import_module(module_name), class_name)